@@ -68,14 +68,20 @@ python ssl4eo_downloader.py \
 
 import argparse
 import csv
+import importlib.util
 import json
 import math
 import os
+import queue
+import threading
 import time
+import traceback
+import types
 import warnings
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-from multiprocessing.dummy import Lock, Pool
+from functools import partial
 from typing import Any, Dict, List, Optional, Tuple
 
 import ee
@@ -85,15 +91,31 @@ import shapefile
 import geopandas as gpd
 import pandas as pd
 from pyproj import CRS
+import requests
 import urllib3
+from ee import _cloud_api_utils
 from rasterio.transform import Affine
 from rtree import index
 from shapely.geometry import Point, shape
 # from torchvision.datasets.utils import download_and_extract_archive
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 warnings.simplefilter("ignore", UserWarning)
 
+# length of one degree of arc on the earth's surface (radius 6371 km)
+_KM_PER_DEG = 2.0 * 6371 * math.pi / 360.0
+_DEG_PER_KM = 1.0 / _KM_PER_DEG
+
 
 """ samplers to get locations of interest points"""
 
@@ -108,7 +130,7 @@ class UniformSampler:
 class GaussianSampler:
     def __init__(
         self,
-        interest_points: Optional[List[List[float]]] = None,
+        interest_points: Optional[Any] = None,
         input_vector: Optional[str] = None,
         num_cities: int = 1000,
         std: float = 20,
@@ -158,8 +180,12 @@ class GaussianSampler:
     @staticmethod
     def get_interest_points_from_vectorfile(
         vector_path: str
-    ) -> List[List[float]]:
-        gdf = gpd.read_file(vector_path)
+    ) -> np.ndarray[Any, np.dtype[Any]]:
+        # pyogrio reads large point layers much faster than fiona
+        if importlib.util.find_spec("pyogrio") is not None:
+            gdf = gpd.read_file(vector_path, engine="pyogrio")
+        else:
+            gdf = gpd.read_file(vector_path)
 
         # Check the current projection
         current_crs = gdf.crs
@@ -175,8 +201,8 @@ class GaussianSampler:
         latitudes = gdf.geometry.y
         longitudes = gdf.geometry.x
 
-        # points = [[float(c["lng"]), float(c["lat"])] for c in cities]
-        points = [[lng, lat ] for lat, lng in zip(latitudes, longitudes)]
+        # (N, 2) array of [lng, lat], rng.choice() samples its rows
+        points = np.column_stack([longitudes.values, latitudes.values])
 
         # save to copy to csv
         save_csv_path = os.path.splitext(os.path.basename(vector_path))[0] + '_latlon.csv'
@@ -188,12 +214,12 @@ class GaussianSampler:
         return points
 
     @staticmethod
-    def km2deg(kms: float, radius: float = 6371) -> float:
-        return kms / (2.0 * radius * np.pi / 360.0)
+    def km2deg(kms: float) -> float:
+        return kms * _DEG_PER_KM
 
     @staticmethod
-    def deg2km(deg: float, radius: float = 6371) -> float:
-        return deg * (2.0 * radius * np.pi / 360.0)
+    def deg2km(deg: float) -> float:
+        return deg * _KM_PER_DEG
 
 
 class BoundedUniformSampler:
@@ -272,7 +298,8 @@ def filter_collection(
     coords: List[float],
     period: Tuple[str, str, str, str],
 ) -> ee.ImageCollection:
-    filtered = collection
+    # filter region first, so the seasons of a location share this expression
+    filtered = collection.filterBounds(ee.Geometry.Point(coords))
     if period is not None:
         # filtered = filtered.filterDate(*period)  # filter time, if there's one period
         filtered = filtered.filter(
@@ -282,12 +309,7 @@ def filter_collection(
             )
         )  # filter time, if there're two periods
 
-    filtered = filtered.filterBounds(ee.Geometry.Point(coords))  # filter region
-
-    if filtered.size().getInfo() == 0:
-        raise ee.EEException(
-            f"ImageCollection.filter: No suitable images found in ({coords[1]:.4f}, {coords[0]:.4f}) between {period[0]} and {period[1]}."  # noqa: E501
-        )
+    # emptiness is checked in get_patches() within the same request as the download
     return filtered
 
 
@@ -317,32 +339,64 @@ def adjust_coords(
     ]
 
 
-def get_properties(image: ee.Image) -> Any:
-    return image.getInfo()
-
-
-def get_patch(
+def get_patch_info(
     collection: ee.ImageCollection,
     center_coord: List[float],
     radius: float,
     bands: List[str],
-    crop: Optional[Dict[str, Any]] = None,
-    dtype: str = "float32",
-) -> Dict[str, Any]:
+) -> ee.ComputedObject:
     image = collection.sort("system:time_start", False).first()  # get most recent
     region = (
         ee.Geometry.Point(center_coord).buffer(radius).bounds()
     )  # sample region bound
     patch = image.select(*bands).sampleRectangle(region, defaultValue=0)
 
-    features = patch.getInfo()  # the actual download
+    # pixels and image metadata, or an empty dictionary if the collection is empty
+    return ee.Algorithms.If(
+        collection.size().gt(0),
+        ee.Dictionary({"features": patch, "metadata": image}),
+        ee.Dictionary({}),
+    )
+
 
-    raster = OrderedDict()
+def get_patch(
+    info: Dict[str, Any],
+    bands: List[str],
+    crop: Optional[Dict[str, Any]] = None,
+    dtype: str = "float32",
+) -> Dict[str, Any]:
+    features = info["features"]
+
+    # group the bands of the same returned size and crop size, to convert and
+    # crop them at once (bands of different resolutions may share a crop size)
+    groups: Dict[Any, List[str]] = OrderedDict()
     for band in bands:
-        img = np.atleast_3d(features["properties"][band])
-        if crop is not None:
-            img = center_crop(img, out_size=crop[band])
-        raster[band] = img.astype(dtype)
+        img = features["properties"][band]
+        key = ((len(img), len(img[0])), None if crop is None else crop[band])
+        groups.setdefault(key, []).append(band)
+    block_shapes = []
+    for (size, out_size), group in groups.items():
+        if out_size is None:
+            out_size = size
+        # never larger than what was returned, like center_crop()
+        out_size = (min(size[0], out_size[0]), min(size[1], out_size[1]))
+        block_shapes.append((len(group), *out_size))
+
+    # one contiguous buffer per patch, holding a (G, h, w) block per group
+    buf = np.empty(sum(math.prod(bs) for bs in block_shapes), dtype=dtype)
+    views = {}
+    offset = 0
+    for group, block_shape in zip(groups.values(), block_shapes):
+        block = buf[offset : offset + math.prod(block_shape)].reshape(block_shape)
+        offset += block.size
+        img = np.asarray([features["properties"][band] for band in group], dtype=dtype)
+        np.copyto(
+            block.transpose(1, 2, 0),
+            center_crop(img.transpose(1, 2, 0), out_size=block_shape[1:]),
+        )
+        for i, band in enumerate(group):
+            views[band] = block[i][:, :, None]
+    raster = OrderedDict((band, views[band]) for band in bands)
 
     coords0 = np.array(features["geometry"]["coordinates"][0])
     coords = [
@@ -359,10 +413,36 @@ def get_patch(
         coords = adjust_coords(coords, old_size, new_size)
 
     return OrderedDict(
-        {"raster": raster, "coords": coords, "metadata": get_properties(image)}
+        {"raster": raster, "coords": coords, "metadata": info["metadata"]}
     )
 
 
+def get_patches(
+    collection: ee.ImageCollection,
+    center_coord: List[float],
+    periods: List[Tuple[str, str, str, str]],
+    radius: float,
+    bands: List[str],
+    crop: Optional[Dict[str, Any]] = None,
+    dtype: str = "float32",
+) -> List[Dict[str, Any]]:
+    filtered_collections = [
+        filter_collection(collection, center_coord, p) for p in periods
+    ]
+    infos = ee.List(
+        [get_patch_info(c, center_coord, radius, bands) for c in filtered_collections]
+    ).getInfo()  # the actual download, one request for all periods
+
+    patches = []
+    for info, period in zip(infos, periods):
+        if not info:
+            raise ee.EEException(
+                f"ImageCollection.filter: No suitable images found in ({center_coord[1]:.4f}, {center_coord[0]:.4f}) between {period[0]} and {period[1]}."  # noqa: E501
+            )
+        patches.append(get_patch(info, bands, crop=crop, dtype=dtype))
+    return patches
+
+
 """ get data --- match from pre-sampled locations """
 
 
@@ -372,29 +452,21 @@ def get_random_patches_match(
     bands: List[str],
     crops: Dict[str, Any],
     dtype: str,
-    dates: List[Any],
+    periods: List[Tuple[str, str, str, str]],
     radius: float,
     debug: bool = False,
-    match_coords: Dict[str, Any] = {},
+    match_coords: Dict[int, Any] = {},
 ) -> Tuple[Optional[List[Dict[str, Any]]], List[float]]:
     # (lon,lat) of idx patch
-    coords = match_coords[str(idx)]
-
-    # random +- 30 days of random days within 1 year from the reference dates
-    periods = [get_period(date, days=60) for date in dates]
+    coords = match_coords[idx]
 
     try:
-        filtered_collections = [
-            filter_collection(collection, coords, p) for p in periods
-        ]
-        patches = [
-            get_patch(c, coords, radius, bands=bands, crop=crops, dtype=dtype)
-            for c in filtered_collections
-        ]
+        patches = get_patches(
+            collection, coords, periods, radius, bands=bands, crop=crops, dtype=dtype
+        )
 
     except (ee.EEException, urllib3.exceptions.HTTPError) as e:
-        if debug:
-            print(e)
+        print(f"no suitable image for location {idx}: {e}")
         return None, coords
 
     return patches, coords
@@ -410,78 +482,157 @@ def get_random_patches_rtree(
     crops: Dict[str, Any],
     dtype: str,
     sampler: GaussianSampler,
-    dates: List[Any],
+    periods: List[Tuple[str, str, str, str]],
     radius: float,
     debug: bool = False,
     rtree_obj: index.Index = None,
-) -> Tuple[List[Dict[str, Any]], List[float]]:
-    # (lon,lat) of top-10000 cities
-    coords = sampler.sample_point()
+    max_retries: int = 100,
+    max_overlaps: int = 10000,
+) -> Tuple[Optional[List[Dict[str, Any]]], List[float]]:
+    # squared minimum distance between two patch centers (degrees)
+    threshold2 = (1.5 * radius / 1000 * _DEG_PER_KM) ** 2
+
+    # resample until a coord passes the overlap check and fits the collection,
+    # giving up after max_retries failed downloads (e.g. a wrong band name) or
+    # max_overlaps overlapping samples (the sampling area is full)
+    failures = 0
+    overlaps = 0
+    while True:
+        # (lon,lat) of top-10000 cities
+        coords = sampler.sample_point()
+
+        # use rtree to avoid strong overlap
+        try:
+            new_coord = (coords[0], coords[1])
+            for i in rtree_obj.nearest(new_coord, num_results=1, objects=True):
+                dx = new_coord[0] - i.bbox[2]
+                dy = new_coord[1] - i.bbox[3]
+                if dx * dx + dy * dy < threshold2:
+                    raise OverlapError
+        except OverlapError:
+            overlaps += 1
+            if overlaps >= max_overlaps:
+                print(
+                    f"no free location for {idx} "
+                    f"after {overlaps} overlapping samples."
+                )
+                return None, coords
+            continue
 
-    # use rtree to avoid strong overlap
-    try:
-        new_coord = (coords[0], coords[1])
-        for i in rtree_obj.nearest(new_coord, num_results=1, objects=True):
-            distance = np.sqrt(
-                sampler.deg2km(abs(new_coord[0] - i.bbox[2])) ** 2
-                + sampler.deg2km(abs(new_coord[1] - i.bbox[3])) ** 2
-            )
-            if distance < (1.5 * radius / 1000):
-                raise OverlapError
+        # also keeps from sampling an old coord that doesn't fit the collection
         rtree_obj.insert(
             len(rtree_obj) - 1, (new_coord[0], new_coord[1], new_coord[0], new_coord[1])
         )
 
-    except OverlapError:
-        patches, center_coord = get_random_patches_rtree(
-            idx,
-            collection,
-            bands,
-            crops,
-            dtype,
-            sampler,
-            dates,
-            radius,
-            debug,
-            rtree_obj,
-        )
+        try:
+            patches = get_patches(
+                collection, coords, periods, radius, bands=bands, crop=crops, dtype=dtype
+            )
+        except (ee.EEException, urllib3.exceptions.HTTPError) as e:
+            if debug:
+                print(e)
+            failures += 1
+            if failures >= max_retries:
+                print(
+                    f"no suitable image for location {idx} "
+                    f"after {failures} failed downloads: {e}"
+                )
+                return None, coords
+            continue
 
-    # random +- 30 days of random days within 1 year from the reference dates
-    periods = [get_period(date, days=60) for date in dates]
+        return patches, coords
 
-    try:
-        filtered_collections = [
-            filter_collection(collection, coords, p) for p in periods
-        ]
-        patches = [
-            get_patch(c, coords, radius, bands=bands, crop=crops, dtype=dtype)
-            for c in filtered_collections
-        ]
-        center_coord = coords
 
-    except (ee.EEException, urllib3.exceptions.HTTPError) as e:
-        if debug:
-            print(e)
-        rtree_obj.insert(
-            len(rtree_obj) - 1, (new_coord[0], new_coord[1], new_coord[0], new_coord[1])
-        )  # prevent from sampling an old coord that doesn't fit the collection
-        patches, center_coord = get_random_patches_rtree(
-            idx,
-            collection,
-            bands,
-            crops,
-            dtype,
-            sampler,
-            dates,
-            radius,
-            debug,
-            rtree_obj,
-        )
+""" sample new coord, check overlap, and get data --- grid """
 
-    return patches, center_coord
 
+def get_grid_index(coord: Tuple[float, float]) -> Tuple[int, int]:
+    # 1 x 1 degree cells
+    return (math.floor(coord[0] + 180), math.floor(coord[1] + 90))
 
-""" sample new coord, check overlap, and get data --- grid """
+
+class GridCell:
+    # coords of one grid cell as growable lon/lat arrays (struct of arrays)
+    def __init__(self, coords: Optional[List[Tuple[float, float]]] = None) -> None:
+        coords = np.asarray(coords if coords else [], dtype=np.float64).reshape(-1, 2)
+        self.size = len(coords)
+        capacity = max(16, self.size)
+        self._lons = np.empty(capacity, dtype=np.float64)
+        self._lats = np.empty(capacity, dtype=np.float64)
+        self._lons[: self.size] = coords[:, 0]
+        self._lats[: self.size] = coords[:, 1]
+        self.lock = threading.Lock()
+
+    def arrays(
+        self,
+    ) -> Tuple[np.ndarray[Any, np.dtype[Any]], np.ndarray[Any, np.dtype[Any]]]:
+        # read size once so both views stay consistent with a concurrent append
+        size = self.size
+        return self._lons[:size], self._lats[:size]
+
+    def append(self, coord: Tuple[float, float]) -> None:
+        with self.lock:
+            if self.size == len(self._lons):  # amortized doubling
+                self._lons = np.resize(self._lons, 2 * self.size)
+                self._lats = np.resize(self._lats, 2 * self.size)
+            self._lons[self.size] = coord[0]
+            self._lats[self.size] = coord[1]
+            self.size += 1
+
+
+def insert_grid(
+    grid_dict: Dict[Tuple[int, int], GridCell], coord: Tuple[float, float]
+) -> None:
+    gridIndex = get_grid_index(coord)
+    cell = grid_dict.get(gridIndex)
+    if cell is None:
+        cell = grid_dict.setdefault(gridIndex, GridCell())
+    cell.append(coord)
+
+
+def min_sqdist(
+    lons: np.ndarray[Any, np.dtype[Any]],
+    lats: np.ndarray[Any, np.dtype[Any]],
+    lon: float,
+    lat: float,
+) -> float:
+    # squared distance (degrees) from (lon, lat) to the closest of the coords
+    dx = lons - lon
+    dy = lats - lat
+    return float((dx * dx + dy * dy).min(initial=np.inf))
+
+
+if njit is not None:
+    # same as above as a compiled loop, without temporaries and releasing the GIL
+    @njit(cache=True, nogil=True)
+    def min_sqdist(lons, lats, lon, lat):  # type: ignore[no-redef] # noqa: F811
+        m = np.inf
+        for i in range(lons.shape[0]):
+            d = (lons[i] - lon) ** 2 + (lats[i] - lat) ** 2
+            if d < m:
+                m = d
+        return m
+
+
+def check_overlap_grid(
+    grid_dict: Dict[Tuple[int, int], GridCell],
+    coord: Tuple[float, float],
+    threshold: float,
+) -> None:
+    # raise OverlapError if an existing coord is closer than threshold (degrees);
+    # only the cells touched by the threshold box around coord are checked, i.e.
+    # the neighbors are included when coord lies near a cell border
+    x0, y0 = get_grid_index((coord[0] - threshold, coord[1] - threshold))
+    x1, y1 = get_grid_index((coord[0] + threshold, coord[1] + threshold))
+    threshold2 = threshold * threshold
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            cell = grid_dict.get((x, y))
+            if cell is None:
+                continue
+            lons, lats = cell.arrays()
+            if min_sqdist(lons, lats, coord[0], coord[1]) < threshold2:
+                raise OverlapError
 
 
 def get_random_patches_grid(
@@ -491,80 +642,67 @@ def get_random_patches_grid(
     crops: Dict[str, Any],
     dtype: str,
     sampler: GaussianSampler,
-    dates: List[Any],
+    periods: List[Tuple[str, str, str, str]],
     radius: float,
     debug: bool = False,
-    grid_dict: Dict[Tuple[int, int], Any] = {},
-) -> Tuple[List[Dict[str, Any]], List[float]]:
-    # (lon,lat) of top-10000 cities
-    coords = sampler.sample_point()
-
-    # avoid strong overlap
-    try:
-        new_coord = (coords[0], coords[1])
-        gridIndex = (math.floor(new_coord[0] + 180), math.floor(new_coord[1] + 90))
-
-        if gridIndex not in grid_dict.keys():
-            grid_dict[gridIndex] = {new_coord}
-        else:
-            for coord in grid_dict[gridIndex]:
-                distance = np.sqrt(
-                    sampler.deg2km(abs(new_coord[0] - coord[0])) ** 2
-                    + sampler.deg2km(abs(new_coord[1] - coord[1])) ** 2
+    grid_dict: Dict[Tuple[int, int], GridCell] = {},
+    max_retries: int = 100,
+    max_overlaps: int = 10000,
+) -> Tuple[Optional[List[Dict[str, Any]]], List[float]]:
+    # minimum distance between two patch centers (degrees)
+    threshold = 1.5 * radius / 1000 * _DEG_PER_KM
+
+    # resample until a coord passes the overlap check and fits the collection,
+    # giving up after max_retries failed downloads (e.g. a wrong band name) or
+    # max_overlaps overlapping samples (the sampling area is full)
+    failures = 0
+    overlaps = 0
+    while True:
+        # (lon,lat) of top-10000 cities
+        coords = sampler.sample_point()
+
+        # avoid strong overlap
+        try:
+            new_coord = (coords[0], coords[1])
+            check_overlap_grid(grid_dict, new_coord, threshold)
+        except OverlapError:
+            overlaps += 1
+            if overlaps >= max_overlaps:
+                print(
+                    f"no free location for {idx} "
+                    f"after {overlaps} overlapping samples."
                 )
-                if distance < (1.5 * radius / 1000):
-                    raise OverlapError
-            grid_dict[gridIndex].add(new_coord)
-
-    except OverlapError:
-        patches, center_coord = get_random_patches_grid(
-            idx,
-            collection,
-            bands,
-            crops,
-            dtype,
-            sampler,
-            dates,
-            radius,
-            debug,
-            grid_dict=grid_dict,
-        )
-
-    # random +- 15 days of random days within 1 year from the reference dates
-    periods = [get_period(date, days=30) for date in dates]
-
-    try:
-        filtered_collections = [
-            filter_collection(collection, coords, p) for p in periods
-        ]
-        patches = [
-            get_patch(c, coords, radius, bands=bands, crop=crops, dtype=dtype)
-            for c in filtered_collections
-        ]
+                return None, coords
+            continue
 
-        center_coord = coords
+        # also keeps from sampling an old coord that doesn't fit the collection
+        insert_grid(grid_dict, new_coord)
 
-    except (ee.EEException, urllib3.exceptions.HTTPError) as e:
-        if debug:
-            print(e)
-        patches, center_coord = get_random_patches_grid(
-            idx,
-            collection,
-            bands,
-            crops,
-            dtype,
-            sampler,
-            dates,
-            radius,
-            debug,
-            grid_dict=grid_dict,
-        )
+        try:
+            patches = get_patches(
+                collection, coords, periods, radius, bands=bands, crop=crops, dtype=dtype
+            )
+        except (ee.EEException, urllib3.exceptions.HTTPError) as e:
+            if debug:
+                print(e)
+            failures += 1
+            if failures >= max_retries:
+                print(
+                    f"no suitable image for location {idx} "
+                    f"after {failures} failed downloads: {e}"
+                )
+                return None, coords
+            continue
 
-    return patches, center_coord
+        return patches, coords
 
 
 def save_geotiff(
-    img: np.ndarray[Any, np.dtype[Any]], coords: List[List[float]], filename: str
+    img: np.ndarray[Any, np.dtype[Any]],
+    coords: List[List[float]],
+    filename: str,
+    band_names: Optional[List[str]] = None,
+    **options: Any,
 ) -> None:
     height, width, channels = img.shape
     xres = (coords[1][0] - coords[0][0]) / width
@@ -580,11 +718,17 @@ def save_geotiff(
         "crs": "+proj=latlong",
         "transform": transform,
         "dtype": img.dtype,
-        "compress": "lzw",
+        # zstd at a low level compresses about as well as lzw at a fraction of
+        # the cpu time (requires GDAL >= 2.3)
+        "compress": "zstd",
+        "zstd_level": 1,
         "predictor": 2,
+        **options,
     }
     with rasterio.open(filename, "w", **profile) as f:
         f.write(img.transpose(2, 0, 1))
+        if band_names is not None:
+            f.descriptions = tuple(band_names)
 
 
 def save_patch(
@@ -592,22 +736,62 @@ def save_patch(
     coords: List[List[float]],
     metadata: Dict[str, Any],
     path: str,
+    merge_bands: bool = False,
 ) -> None:
     patch_id = metadata["properties"]["system:index"]
     patch_path = os.path.join(path, patch_id)
     os.makedirs(patch_path, exist_ok=True)
 
-    for band, img in raster.items():
-        save_geotiff(img, coords, os.path.join(patch_path, f"{band}.tif"))
+    if merge_bands:
+        # one multi-band file per group of bands sharing the same size (crop)
+        groups: Dict[Tuple[int, int], List[str]] = OrderedDict()
+        for band, img in raster.items():
+            groups.setdefault(img.shape[:2], []).append(band)
+        for group in groups.values():
+            save_geotiff(
+                np.concatenate([raster[band] for band in group], axis=2),
+                coords,
+                os.path.join(patch_path, "_".join(group) + ".tif"),
+                band_names=group,
+                bigtiff="IF_SAFER",
+            )
+    else:
+        for band, img in raster.items():
+            save_geotiff(img, coords, os.path.join(patch_path, f"{band}.tif"))
 
     with open(os.path.join(patch_path, "metadata.json"), "w") as f:
         json.dump(metadata, f)
 
 
+def use_fast_json() -> None:
+    # the ee client decodes responses (the pixel arrays) through googleapiclient,
+    # which uses the stdlib json module; swap in orjson's decoder if available
+    if orjson is None:
+        return
+    from googleapiclient import model
+
+    # keep json.decoder, deserialize() catches json.decoder.JSONDecodeError (which
+    # orjson.JSONDecodeError subclasses) to return non-JSON bodies as they are
+    model.json = types.SimpleNamespace(
+        loads=orjson.loads, dumps=json.dumps, decoder=json.decoder
+    )
+
+
+def get_http_transport(pool_size: int) -> Any:
+    # ee issues all requests through one requests.Session, whose connection pool
+    # holds 10 connections by default; size it for the worker threads so that
+    # connections (and their TLS handshakes) are reused instead of discarded
+    session = requests.Session()
+    session.mount(
+        "https://", requests.adapters.HTTPAdapter(pool_maxsize=max(pool_size, 1))
+    )
+    return _cloud_api_utils._Http(session)
+
+
 class Counter:
     def __init__(self, start: int = 0) -> None:
         self.value = start
-        self.lock = Lock()
+        self.lock = threading.Lock()
 
     def update(self, delta: int = 1) -> int:
         with self.lock:
@@ -686,6 +870,11 @@ if __name__ == "__main__":
         help="crop size for each band",
     )
     parser.add_argument("--dtype", type=str, default="float32", help="data type")
+    parser.add_argument(
+        "--merge_bands",
+        action="store_true",
+        help="save one multi-band tif per group of bands with the same crop size",
+    )
     # sampler properties
     parser.add_argument(
         "--num_cities", type=int, default=10000, help="number of cities to sample"
@@ -694,7 +883,12 @@ if __name__ == "__main__":
         "--std", type=int, default=50, help="std of gaussian distribution"
     )
     # download settings
-    parser.add_argument("--num_workers", type=int, default=8, help="number of workers")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=8,
+        help="number of worker threads (downloading is I/O-bound, 64-128 is fine)",
+    )
     parser.add_argument("--log_freq", type=int, default=10, help="print frequency")
     parser.add_argument(
         "--resume", type=str, default=None, help="resume from a previous run"
@@ -715,6 +909,18 @@ if __name__ == "__main__":
         choices=["grid", "rtree", None],
         help="overlap check method",
     )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=100,
+        help="failed downloads before giving up on a location (grid/rtree)",
+    )
+    parser.add_argument(
+        "--max_overlaps",
+        type=int,
+        default=10000,
+        help="overlapping samples before giving up on a location (grid/rtree)",
+    )
     # number of locations to download
     parser.add_argument(
         "--indices_range",
@@ -731,7 +937,8 @@ if __name__ == "__main__":
     fix_random_seeds(seed=42)
 
     # initialize ee
-    ee.Initialize()
+    use_fast_json()
+    ee.Initialize(http_transport=get_http_transport(args.num_workers))
 
     # get data collection (remove clouds)
     collection = get_collection(args.collection, args.meta_cloud_name, args.cloud_pct)
@@ -743,6 +950,13 @@ if __name__ == "__main__":
     for d in args.dates:
         dates.append(date.fromisoformat(d))
 
+    # random +- 30 days (+- 15 days for grid) of random days within 1 year from
+    # the reference dates
+    if args.match_file is None and args.overlap_check == "grid":
+        periods = [get_period(d, days=30) for d in dates]
+    else:
+        periods = [get_period(d, days=60) for d in dates]
+
     bands = args.bands
     crops = {}
     for i, band in enumerate(bands):
@@ -757,13 +971,14 @@ if __name__ == "__main__":
         with open(ext_path) as csv_file:
             reader = csv.reader(csv_file)
             for row in reader:
-                key = row[0]
+                key = int(row[0])
                 val1 = float(row[1])
                 val2 = float(row[2])
                 ext_coords[key] = (val1, val2)  # lon, lat
                 ext_flags[key] = int(row[3])  # success or not
     else:
         ext_path = os.path.join(args.save_path, "checked_locations.csv")
+        os.makedirs(args.save_path, exist_ok=True)
 
     # if match from pre-sampled coords (e.g. SSL4EO-S12)
     if args.match_file:
@@ -771,79 +986,108 @@ if __name__ == "__main__":
         with open(args.match_file) as csv_file:
             reader = csv.reader(csv_file)
             for row in reader:
-                key = row[0]
+                key = int(row[0])
                 val1 = float(row[1])
                 val2 = float(row[2])
                 match_coords[key] = (val1, val2)  # lon, lat
     # else need to check overlap
     # build grid or rtree from existing coordinates
     elif args.overlap_check is not None:
-        grid_dict: Dict[Any, Any] = {}
+        grid_dict: Dict[Tuple[int, int], GridCell] = {}
         rtree_coords = index.Index()
-        if args.resume:
+        if args.resume and ext_coords:
             print("Load existing locations.")
-            for i, key in enumerate(tqdm(ext_coords.keys())):
-                c = ext_coords[key]
-                rtree_coords.insert(i, (c[0], c[1], c[0], c[1]))
-                gridIndex = (math.floor(c[0] + 180), math.floor(c[1] + 90))
-                if gridIndex not in grid_dict.keys():
-                    grid_dict[gridIndex] = {c}
-                else:
-                    grid_dict[gridIndex].add(c)
+            if args.overlap_check == "rtree":
+                # stream (bulk) loading, faster and better packed than inserting
+                # the coords one by one
+                rtree_coords = index.Index(
+                    (i, (c[0], c[1], c[0], c[1]), None)
+                    for i, c in enumerate(tqdm(ext_coords.values()))
+                )
+            else:
+                grid_lists: Dict[Any, List[Tuple[float, float]]] = {}
+                for c in tqdm(ext_coords.values()):
+                    grid_lists.setdefault(get_grid_index(c), []).append(c)
+                for gridIndex, cell_coords in grid_lists.items():
+                    grid_dict[gridIndex] = GridCell(cell_coords)
     else:
         raise NotImplementedError
 
     start_time = time.time()
     counter = Counter()
 
+    # a single thread appends checked locations, fed by the workers
+    log_q: "queue.Queue[Optional[List[Any]]]" = queue.Queue()
+
+    def log_writer() -> None:
+        with open(ext_path, "a", buffering=1 << 16) as f:
+            writer = csv.writer(f)
+            while True:
+                row = log_q.get()
+                if row is None:  # sentinel, shutdown
+                    break
+                writer.writerow(row)
+                if log_q.empty():  # flush once the backlog is written
+                    f.flush()
+
+    log_thread = threading.Thread(target=log_writer, daemon=True)
+    log_thread.start()
+
+    # choose the sampling method once, workers only pass the index
+    if args.match_file:
+        get_random_patches = partial(
+            get_random_patches_match,
+            collection=collection,
+            bands=bands,
+            crops=crops,
+            dtype=dtype,
+            periods=periods,
+            radius=args.radius,
+            debug=args.debug,
+            match_coords=match_coords,
+        )
+    elif args.overlap_check == "rtree":
+        get_random_patches = partial(
+            get_random_patches_rtree,
+            collection=collection,
+            bands=bands,
+            crops=crops,
+            dtype=dtype,
+            sampler=sampler,
+            periods=periods,
+            radius=args.radius,
+            debug=args.debug,
+            rtree_obj=rtree_coords,
+            max_retries=args.max_retries,
+            max_overlaps=args.max_overlaps,
+        )
+    elif args.overlap_check == "grid":
+        get_random_patches = partial(
+            get_random_patches_grid,
+            collection=collection,
+            bands=bands,
+            crops=crops,
+            dtype=dtype,
+            sampler=sampler,
+            periods=periods,
+            radius=args.radius,
+            debug=args.debug,
+            grid_dict=grid_dict,
+            max_retries=args.max_retries,
+            max_overlaps=args.max_overlaps,
+        )
+    else:
+        raise NotImplementedError
+
     def worker(idx: int) -> None:
-        if str(idx) in ext_coords.keys():
+        if idx in ext_flags:
             if args.match_file:  # skip all processed ids
                 return
             else:
-                if ext_flags[str(idx)] != 0:  # only skip downloaded ids
+                if ext_flags[idx] != 0:  # only skip downloaded ids
                     return
 
-        if args.match_file:
-            patches, center_coord = get_random_patches_match(
-                idx,
-                collection,
-                bands,
-                crops,
-                dtype,
-                dates,
-                radius=args.radius,
-                debug=args.debug,
-                match_coords=match_coords,
-            )
-        elif args.overlap_check == "rtree":
-            patches, center_coord = get_random_patches_rtree(
-                idx,
-                collection,
-                bands,
-                crops,
-                dtype,
-                sampler,
-                dates,
-                radius=args.radius,
-                debug=args.debug,
-                rtree_obj=rtree_coords,
-            )
-        elif args.overlap_check == "grid":
-            patches, center_coord = get_random_patches_grid(
-                idx,
-                collection,
-                bands,
-                crops,
-                dtype,
-                sampler,
-                dates,
-                radius=args.radius,
-                debug=args.debug,
-                grid_dict=grid_dict,
-            )
-        else:
-            raise NotImplementedError
+        patches, center_coord = get_random_patches(idx)
 
         if patches is not None:
             if args.save_path is not None:
@@ -856,34 +1100,29 @@ if __name__ == "__main__":
                         coords=patch["coords"],
                         metadata=patch["metadata"],
                         path=location_path,
+                        merge_bands=args.merge_bands,
                     )
 
             count = counter.update(1)
             if count % args.log_freq == 0:
                 print(f"Downloaded {count} images in {time.time() - start_time:.3f}s.")
-        else:
-            print("no suitable image for location %d." % (idx))
 
         # add to existing checked locations
-        with open(ext_path, "a") as f:
-            writer = csv.writer(f)
-            if patches is not None:
-                if args.match_file:
-                    success = 2
-                else:
-                    success = 1
+        if patches is not None:
+            if args.match_file:
+                success = 2
             else:
-                success = 0
-            data = [idx, center_coord[0], center_coord[1], success]
-            writer.writerow(data)
+                success = 1
+        else:
+            success = 0
+        data = [idx, center_coord[0], center_coord[1], success]
+        log_q.put(data)
 
         return
 
     # set indices
     if args.match_file is not None:
-        indices = []
-        for key in match_coords.keys():
-            indices.append(int(key))
+        indices = list(match_coords.keys())
         indices = indices[args.indices_range[0] : args.indices_range[1]]
     elif args.indices_range is not None:
         indices = list(range(args.indices_range[0], args.indices_range[1]))
@@ -891,10 +1130,25 @@ if __name__ == "__main__":
         print("Please set up indices.")
         raise NotImplementedError
 
-    if args.num_workers == 0:
-        for i in indices:
-            worker(i)
-    else:
-        # parallelism data
-        with Pool(processes=args.num_workers) as p:
-            p.map(worker, indices)
+    try:
+        if args.num_workers == 0:
+            for i in indices:
+                worker(i)
+        else:
+            # parallelism data, keep a bounded window of in-flight locations so that
+            # memory stays flat however long the indices list is
+            slots = threading.BoundedSemaphore(2 * args.num_workers)
+
+            def release(future: Future) -> None:
+                slots.release()
+                e = future.exception()
+                if e is not None:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+
+            with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+                for i in indices:
+                    slots.acquire()
+                    executor.submit(worker, i).add_done_callback(release)
+    finally:
+        log_q.put(None)
+        log_thread.join()
@@ -242,28 +242,23 @@ def adjust_coords(coords, old_size, new_size):
     ]
 
 
-def get_properties(image):
-    #properties = {}
-    #for property in image.propertyNames().getInfo():
-    #    properties[property] = image.get(property)
-    #return ee.Dictionary(properties).getInfo()
-    return image.getInfo()
-
 def get_patch_s1(collection, coords, radius, bands=None, crop=None):
 
     image = collection.sort('system:time_start', False).first()  # get most recent
     region = ee.Geometry.Point(coords).buffer(radius).bounds() # sample region bound
 
     patch = image.select(*bands).sampleRectangle(region,defaultValue=0)
-    features = patch.getInfo()  # the actual download
+    # the actual download, pixels and image metadata in one request
+    info = ee.Dictionary({'features': patch, 'metadata': image}).getInfo()
+    features = info['features']
 
     raster = OrderedDict()
     for band in bands:
-        img = np.atleast_3d(features['properties'][band])
+        img = np.asarray(features['properties'][band], dtype='float32')[..., None]
         if crop is not None:
             img = center_crop(img, out_size=crop[band])
         #img = rescale_intensity(img, in_range=(0, 1), out_range=np.uint8)
-        raster[band] = img.astype('float32')
+        raster[band] = img
 
     coords = np.array(features['geometry']['coordinates'][0])
     coords = [
@@ -279,7 +274,7 @@ def get_patch_s1(collection, coords, radius, bands=None, crop=None):
     return OrderedDict({
         'raster': raster,
         'coords': coords,
-        'metadata': get_properties(image)
+        'metadata': info['metadata']
     })
 
 
@@ -292,16 +287,17 @@ def get_patch_s2(collection, coords, radius, bands=None, crop=None):
     region = ee.Geometry.Point(coords).buffer(radius).bounds() # sample region bound
     #pdb.set_trace()
     patch = image.select(*bands).sampleRectangle(region,defaultValue=0)
-
-    features = patch.getInfo()  # the actual download
+    # the actual download, pixels and image metadata in one request
+    info = ee.Dictionary({'features': patch, 'metadata': image}).getInfo()
+    features = info['features']
 
     raster = OrderedDict()
     for band in bands:
-        img = np.atleast_3d(features['properties'][band])
+        img = np.asarray(features['properties'][band], dtype='uint16')[..., None]
         if crop is not None:
             img = center_crop(img, out_size=crop[band])
         #img = rescale_intensity(img, in_range=(0, 1), out_range=np.uint8)
-        raster[band] = img.astype('uint16')
+        raster[band] = img
 
     coords = np.array(features['geometry']['coordinates'][0])
     coords = [
@@ -317,7 +313,7 @@ def get_patch_s2(collection, coords, radius, bands=None, crop=None):
     return OrderedDict({
         'raster': raster,
         'coords': coords,
-        'metadata': get_properties(image)
+        'metadata': info['metadata']
     })
 
 